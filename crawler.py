@@ -1,23 +1,43 @@
-import threading
-import time
+import os
+import asyncio
 import concurrent.futures
-import requests
-from bs4 import BeautifulSoup
-from typing import List, Set, Optional, Deque
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+import aiohttp
+from pybloom_live import ScalableBloomFilter
+from typing import Dict, List, Optional, Set, Tuple
 
 # Import the separated utility functions
 from funcs import (
     FILES_DIR, QUEUE_FILE, get_max_index, url_exists_in_index,
-    write_content_file, load_queue_from_file, save_queue_to_file,
-    extract_html_text, extract_valid_urls, is_url_valid_for_host,
+    write_content_file, load_queue_from_file, MmapUrlQueue,
+    parse_and_extract, is_url_valid_for_host,
+    normalize_and_clean_url, flush_index_file, close_index_file, close_content_dir,
 )
 
+# Finished URLs are committed in the persistent queue (after flushing their
+# index rows) in batches of this size, and once on shutdown
+QUEUE_COMMIT_EVERY_URLS = 64
+
+# Retry connection errors (e.g. a pooled keep-alive connection the server has
+# since closed) this many times, backing off 0.3s, 0.6s, ...
+FETCH_RETRIES = 2
+FETCH_RETRY_BACKOFF_SECONDS = 0.3
+
+# A page that crashes a parse worker on its own is requeued at most this many
+# times, so it can't loop forever
+PARSE_POOL_CRASH_RETRIES = 2
+
+# Pages larger than this are skipped: without downloading if Content-Length
+# says so, otherwise as soon as the streamed body exceeds it
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+
 
 class Crawler:
     """
     Orchestrates the web crawling process, managing the queue and interacting
-    with helper functions for processing and persistence. Uses parallel execution
-    to improve performance.
+    with helper functions for processing and persistence. Uses asyncio workers
+    sharing a single HTTP session to keep many requests in flight.
     """
     
     def __init__(self, host_includes: str, initial_urls: List[str], max_workers: int = 10):
@@ -27,22 +47,43 @@ class Crawler:
         Args:
             host_includes: Substring that crawled URLs' hosts must contain.
             initial_urls: A list of starting URLs for the crawl.
-            max_workers: Maximum number of parallel workers for crawling.
+            max_workers: Maximum number of concurrent workers for crawling.
         """
 
         self.host_includes: str = host_includes
         self.current_index: int = get_max_index() + 1
         self.max_workers: int = max_workers
 
-        # Load the queue from persistent storage
-        self.queue: Deque[str] = load_queue_from_file()
+        # Open the persistent queue; it is updated in place as URLs are
+        # enqueued, and URLs are only dropped from it once committed
+        self.queue: MmapUrlQueue = load_queue_from_file()
+        self._done_since_commit: int = 0
 
         # Keep track of URLs currently in the queue or being processed
-        # to avoid adding duplicates during *this* run.
-        self.urls_in_session: Set[str] = set(self.queue)
+        # to avoid adding duplicates during *this* run. A Bloom filter takes a
+        # fraction of the memory of a set of URL strings, but a false positive
+        # is never fetched, and since indexed pages are never parsed again it
+        # (and anything only linked from it) is missed for good. Hence the low
+        # error rate: ~1.5 MB and fewer than 10 missed URLs per 500k URLs.
+        self.urls_in_session = ScalableBloomFilter(
+            initial_capacity=100_000, error_rate=1e-5,
+            mode=ScalableBloomFilter.LARGE_SET_GROWTH,
+        )
+        for url in self.queue:
+            self.urls_in_session.add(url)
+
+        # Created inside the event loop by _run(); wakes idle workers when
+        # URLs are enqueued or the last active worker finishes.
+        self._queue_ready: Optional[asyncio.Condition] = None
+        self._active_workers: int = 0
 
-        # Lock for thread-safe operations on shared resources
-        self.lock = threading.RLock()
+        # Created by _run(); parses pages on all cores, outside the GIL of this process
+        self._parse_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # URLs whose parse was lost to a dead parse worker, with the number of
+        # times they crashed the single-process suspect pool (see _parse_page)
+        self._parse_crashes: Dict[str, int] = {}
+        self._suspect_parse_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._suspect_parse_lock: Optional[asyncio.Lock] = None
 
         # Initialize queue if it was empty
         self._initialize_queue(initial_urls)
@@ -52,6 +93,8 @@ class Crawler:
         if not self.queue:
             print("Queue is empty. Initializing with provided URLs.")
             for url in initial_urls:
+                # Canonicalize like extracted links so both dedup against each other
+                url = normalize_and_clean_url(url, url) or url
                 # Check if the initial URL itself is valid and not already processed
                 if (is_url_valid_for_host(url, self.host_includes) and
                         not url_exists_in_index(url)):
@@ -62,35 +105,144 @@ class Crawler:
                 else:
                      print(f"Skipping invalid or already processed initial URL: {url}")
 
-    def _fetch_page(self, url: str, timeout: int = 10) -> Optional[BeautifulSoup]:
+    async def _fetch_page(self, session: aiohttp.ClientSession, url: str,
+                          timeout: int = 10) -> Optional[Tuple[bytes, Optional[str]]]:
         """
-        Fetches the content of a URL and returns a BeautifulSoup object.
-        Handles network errors. Returns None on failure.
+        Fetches the content of a URL and returns the raw response body along
+        with the charset declared in its Content-Type header (or None).
+        Handles network errors. Returns None on failure, or if the response
+        isn't HTML or exceeds MAX_PAGE_BYTES.
         """
         print(f"Fetching: {url}")
         try:
-            response = requests.get(url, timeout=timeout)
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-            # Use 'html.parser' for built-in, lxml is faster if installed
-            soup = BeautifulSoup(response.content, "html.parser")
-            return soup
-        except requests.exceptions.Timeout:
+            for attempt in range(FETCH_RETRIES + 1):
+                try:
+                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        response.raise_for_status()  # Raise ClientResponseError for bad responses (4xx or 5xx)
+                        # Only the headers have arrived so far; bail out before
+                        # downloading bodies that aren't HTML or are too large
+                        content_type = response.headers.get('Content-Type', '').lower()
+                        if content_type and 'html' not in content_type and 'xml' not in content_type:
+                            print(f"Skipping non-HTML content ({content_type}): {url}")
+                            return None
+                        if response.content_length is not None and response.content_length > MAX_PAGE_BYTES:
+                            print(f"Skipping oversized page ({response.content_length} bytes): {url}")
+                            return None
+                        # Content-Length is missing for chunked responses and is the
+                        # compressed size for gzip, so also cap the decoded body as it streams
+                        chunks = []
+                        size = 0
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            size += len(chunk)
+                            if size > MAX_PAGE_BYTES:
+                                print(f"Skipping oversized page (over {MAX_PAGE_BYTES} bytes): {url}")
+                                return None
+                            chunks.append(chunk)
+                        content = b''.join(chunks)
+                        charset = response.charset
+                    break
+                except aiohttp.ClientConnectionError:
+                    if attempt == FETCH_RETRIES:
+                        raise
+                    await asyncio.sleep(FETCH_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            return content, charset
+        except asyncio.TimeoutError:
             print(f"Timeout error fetching {url}")
             return None
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientError as e:
             print(f"Failed to fetch {url}. Error: {e}")
             return None
         except Exception as e:
-            # Catch other potential errors during request/parsing (less common)
-            print(f"Unexpected error fetching/parsing {url}: {e}")
+            # Catch other potential errors during the request (less common)
+            print(f"Unexpected error fetching {url}: {e}")
             return None
 
-    def _process_url(self, url: str, delay_seconds: float = 0.1) -> None:
+    async def _parse_page(self, url: str, content: bytes,
+                          charset: Optional[str]) -> Optional[Tuple[str, Set[str]]]:
+        """
+        Extracts the text and valid links from a fetched page in the parse
+        process pool, so parsing runs on other cores while the event loop keeps
+        doing network I/O. Returns None if the page can't be parsed, or if a
+        parse worker died and the URL was requeued.
+
+        A worker dying fails every parse in flight on its pool, so the page
+        that caused it is unknown. Those pages are parsed again one at a time
+        in a single-process pool, and only a crash there counts against a page.
+        """
+        suspect = url in self._parse_crashes
+        if suspect:
+            await self._suspect_parse_lock.acquire()
+        pool = self._suspect_parse_pool if suspect else self._parse_pool
+        loop = asyncio.get_running_loop()
+        try:
+            parsed = await loop.run_in_executor(
+                pool, parse_and_extract, content, url, self.host_includes, charset
+            )
+        except BrokenProcessPool:
+            # A worker process died (e.g. OOM-killed); every later submit to this
+            # pool would fail, so replace it before requeueing the URL
+            self._restart_parse_pool(pool)
+            await self._requeue_after_parse_crash(url, crashed_alone=suspect)
+            return None
+        except Exception as e:
+            print(f"Unexpected error parsing {url}: {e}")
+            parsed = None
+        finally:
+            if suspect:
+                self._suspect_parse_lock.release()
+        self._parse_crashes.pop(url, None)
+        return parsed
+
+    @staticmethod
+    def _new_parse_pool(max_workers: Optional[int] = None) -> concurrent.futures.ProcessPoolExecutor:
+        """
+        Creates a parse process pool (one process per core by default). Uses
+        forkserver (or spawn) rather than fork, since aiohttp's resolver threads
+        are already running by the time the first page is submitted and forking
+        a threaded process is unsafe.
+        """
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context(start_method),
+        )
+
+    def _restart_parse_pool(self, broken_pool: concurrent.futures.ProcessPoolExecutor) -> None:
+        """Replaces a broken parse pool, unless another worker already did."""
+        if broken_pool is self._parse_pool:
+            print("A parse worker process died. Starting a new parse pool.")
+            self._parse_pool = self._new_parse_pool()
+        elif broken_pool is self._suspect_parse_pool:
+            self._suspect_parse_pool = self._new_parse_pool(max_workers=1)
+        else:
+            return
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _requeue_after_parse_crash(self, url: str, crashed_alone: bool) -> None:
+        """
+        Puts a URL whose parse was lost to a dead worker back on the queue.
+        crashed_alone means it was the only page being parsed, so it caused
+        the crash; it is dropped after PARSE_POOL_CRASH_RETRIES of those.
+        """
+        crashes = self._parse_crashes.get(url, 0) + int(crashed_alone)
+        if crashes > PARSE_POOL_CRASH_RETRIES:
+            print(f"Giving up on {url}: parsing it crashed the parser {crashes} times.")
+            del self._parse_crashes[url]
+            return
+        self._parse_crashes[url] = crashes
+        print(f"Requeueing {url} after a parse worker died.")
+        self.queue.append(url)
+        async with self._queue_ready:
+            self._queue_ready.notify(1)
+
+    async def _process_url(self, session: aiohttp.ClientSession, url: str,
+                           delay_seconds: float = 0.1) -> None:
         """
         Processes a single URL by fetching, extracting content and links,
         and updating the queue.
         
         Args:
+            session: The shared HTTP session.
             url: The URL to process
             delay_seconds: Optional delay between requests to be polite.
         """
@@ -100,102 +252,141 @@ class Crawler:
             return
 
         # --- Fetch Page ---
-        soup = self._fetch_page(url)
-        if soup is None:
+        fetched = await self._fetch_page(session, url)
+        if fetched is None:
             # Error message already printed by _fetch_page
             return
+        content, charset = fetched
 
         # --- Process Content ---
-        text_content = extract_html_text(soup)
+        parsed = await self._parse_page(url, content, charset)
+        if parsed is None:
+            return
+        text_content, new_urls = parsed
 
         # --- Persist Content and Index ---
-        with self.lock:
-            # Thread-safe access to current_index
-            current_index = self.current_index
-            self.current_index += 1
-        
-        # write_content_file also checks url_exists_in_index internally
-        file_written = write_content_file(
-            content=text_content,
-            index=current_index,
-            url=url
+        # Coroutines only switch at awaits, so no lock is needed here
+        current_index = self.current_index
+        self.current_index += 1
+
+        # The index was checked on entry and urls_in_session keeps this URL from
+        # being processed twice, so write_content_file doesn't re-check it.
+        # Run it in the default (thread) executor to keep disk I/O off the event loop.
+        loop = asyncio.get_running_loop()
+        file_written = await loop.run_in_executor(
+            None, write_content_file, text_content, current_index, url
         )
 
         if file_written:
             print(f" -> Saved content to '{FILES_DIR}/{current_index}.txt'")
 
-            # --- Extract and Enqueue New URLs ---
-            new_urls = extract_valid_urls(soup, url, self.host_includes)
+            # --- Enqueue New URLs ---
             print(f" -> Found {len(new_urls)} potentially new valid URLs.")
 
-            added_count = 0
-            with self.lock:
-                for new_url in new_urls:
-                    # Add if not already processed (check index) AND not already in queue/session
-                    if new_url not in self.urls_in_session and not url_exists_in_index(new_url):
-                        self.urls_in_session.add(new_url)
-                        self.queue.append(new_url)
-                        added_count += 1
-            if added_count > 0:
-                print(f" -> Added {added_count} new URLs to the queue.")
+            added_urls = []
+            for new_url in new_urls:
+                # Add if not already processed (check index) AND not already in queue/session
+                if new_url not in self.urls_in_session and not url_exists_in_index(new_url):
+                    self.urls_in_session.add(new_url)
+                    added_urls.append(new_url)
+            if added_urls:
+                self.queue.extend(added_urls)
+                print(f" -> Added {len(added_urls)} new URLs to the queue.")
+                async with self._queue_ready:
+                    self._queue_ready.notify(len(added_urls))
 
         # --- Polite Delay ---
         if delay_seconds > 0:
-            time.sleep(delay_seconds)
+            await asyncio.sleep(delay_seconds)
+
+    async def _worker(self, session: aiohttp.ClientSession, delay_seconds: float) -> None:
+        """
+        Takes URLs from the queue and processes them one at a time. Returns once
+        the queue is empty and no other worker is still processing (and so
+        could enqueue more URLs).
+        """
+        while True:
+            async with self._queue_ready:
+                while not self.queue and self._active_workers > 0:
+                    await self._queue_ready.wait()
+                if not self.queue:
+                    return
+                token, url = self.queue.take()
+                self._active_workers += 1
+
+            completed = False
+            try:
+                await self._process_url(session, url, delay_seconds)
+                completed = True
+            finally:
+                # Unfinished URLs (cancelled or failed) are left uncommitted and
+                # are replayed from the queue file on the next run
+                if completed:
+                    self.queue.task_done(token)
+                    self._done_since_commit += 1
+                    if self._done_since_commit >= QUEUE_COMMIT_EVERY_URLS:
+                        self._commit_queue()
+                async with self._queue_ready:
+                    self._active_workers -= 1
+                    # Idle workers are already woken when URLs are enqueued, so
+                    # only wake them here once the crawl is done and they can exit
+                    if self._active_workers == 0 and not self.queue:
+                        self._queue_ready.notify_all()
+
+    def _commit_queue(self) -> None:
+        """
+        Flushes index rows for finished URLs, then drops those URLs from the
+        persistent queue. In this order, a crash can only replay a URL, never
+        lose one.
+        """
+        flush_index_file()
+        self.queue.commit()
+        self._done_since_commit = 0
+
+    async def _run(self, delay_seconds: float) -> None:
+        """
+        Runs max_workers workers over one shared HTTP session and a process pool
+        for parsing, until the queue is drained.
+        """
+        self._queue_ready = asyncio.Condition()
+        self._suspect_parse_lock = asyncio.Lock()
+        self._active_workers = 0
+
+        # Pool connections across the whole run; cap per-host connections to stay polite.
+        # Nearly every request goes to the same host, so keep idle connections (and
+        # their TLS sessions) alive between pages and cache DNS lookups.
+        connector = aiohttp.TCPConnector(
+            limit=self.max_workers, limit_per_host=8,
+            keepalive_timeout=60, ttl_dns_cache=300,
+        )
+        self._parse_pool = self._new_parse_pool()
+        self._suspect_parse_pool = self._new_parse_pool(max_workers=1)
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await asyncio.gather(
+                    *(self._worker(session, delay_seconds) for _ in range(self.max_workers))
+                )
+        finally:
+            # The pools may have been replaced after a worker died; shut down the current ones
+            self._parse_pool.shutdown()
+            self._suspect_parse_pool.shutdown()
 
     def run(self, delay_seconds: float = 0.1):
         """
-        Starts and manages the iterative crawling process with parallel execution.
+        Starts and manages the crawling process on an asyncio event loop.
 
         Args:
             delay_seconds: Optional delay between requests to be polite.
         """
         try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                futures = []
-                
-                while True:
-                    # Get a batch of URLs to process
-                    urls_to_process = []
-                    with self.lock:
-                        # Get up to max_workers URLs from queue
-                        for _ in range(min(self.max_workers - len(futures), len(self.queue))):
-                            if self.queue:
-                                urls_to_process.append(self.queue.popleft())
-                    
-                    # If no URLs to process and no pending futures, we're done
-                    if not urls_to_process and not futures:
-                        break
-                    
-                    # Submit new tasks for the URLs
-                    for url in urls_to_process:
-                        future = executor.submit(self._process_url, url, delay_seconds)
-                        futures.append(future)
-                    
-                    # Check for completed futures
-                    completed = []
-                    for future in futures:
-                        if future.done():
-                            completed.append(future)
-                    
-                    # Remove completed futures from the tracking list
-                    for future in completed:
-                        futures.remove(future)
-                    
-                    # If we have no URLs to process but have pending futures,
-                    # wait a bit for more work
-                    if not urls_to_process and futures:
-                        time.sleep(0.1)
-                    
-                    # Periodically save queue state
-                    with self.lock:
-                        save_queue_to_file(self.queue)
-
+            asyncio.run(self._run(delay_seconds))
         except KeyboardInterrupt:
             print("\nInterrupt received. Gracefully shutting down...")
         finally:
             # --- Save Final Queue State ---
             print("\nExiting crawl loop (finished or interrupted). Saving queue...")
-            with self.lock:
-                save_queue_to_file(self.queue)
+            self._commit_queue()
+            self.queue.close()
+            close_index_file()
+            close_content_dir()
             print(f"Queue state saved to '{QUEUE_FILE}'. Processed up to index {self.current_index -1}.")
\ No newline at end of file
@@ -1,18 +1,45 @@
 import os
 import csv
-from typing import Set, Deque, Optional
+import atexit
+import re
+import threading
+import functools
+import mmap
+import struct
+from typing import Dict, Set, Iterable, Optional, TextIO, Tuple
 from urllib import parse
-from collections import deque
-import pandas as pd
-from bs4 import BeautifulSoup
+from lxml import etree, html
 
 # --- Constants ---
 INDEX_FILE = "index.csv"
 FILES_DIR = "files"
-QUEUE_FILE = "crawl_queue.txt"
+QUEUE_FILE = "crawl_queue.bin"
+LEGACY_QUEUE_FILE = "crawl_queue.txt" # Text queue format used before the mmap queue
+
+# Runs of spaces/tabs inside extracted text lines
+_WS_RE = re.compile(r"[ \t]{2,}")
+
+# Anchors that never lead to a crawlable page (scripts, mail/phone/data links, in-page anchors)
+_SKIPPED_HREF_RE = re.compile(r"\s*(?:javascript:|mailto:|tel:|data:|#)", re.IGNORECASE)
+
+# Common non-HTML extensions, as '.ext' suffixes for a single str.endswith check
+_NON_HTML_EXTENSIONS = frozenset({
+    'jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp',  # Images
+    'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'ppts', 'psd', 'rdf', 'm4v',  # Documents
+    'zip', 'rar', 'gz', 'tar', '7z',  # Archives
+    'css', 'js',  # Web resources (often linked, but not crawled for content)
+    'xml', 'json', 'csv', 'txt',  # Data formats
+    'mp3', 'mp4', 'avi', 'mov', 'wav',  # Media
+    'exe', 'dmg', 'iso' # Executables/Images
+})
+_NON_HTML_SUFFIXES = tuple('.' + ext for ext in _NON_HTML_EXTENSIONS)
+
+# Parsed-URL results are cached since the same URLs recur across pages
+_URL_CACHE_SIZE = 65536
 
 # --- Pure Functions (or close approximations) ---
 
+@functools.lru_cache(maxsize=_URL_CACHE_SIZE)
 def get_host_from_url(url: str) -> str:
     """
     Extracts the network location (hostname) from a URL. Pure function.
@@ -31,6 +58,7 @@ def get_host_from_url(url: str) -> str:
         # Handle potential errors if url is severely malformed, although urlparse is robust
         return ""
 
+@functools.lru_cache(maxsize=_URL_CACHE_SIZE)
 def is_likely_html_page(url: str) -> bool:
     """
     Checks if a URL likely points to an HTML page based on its path extension.
@@ -44,34 +72,19 @@ def is_likely_html_page(url: str) -> bool:
     """
     try:
         path = parse.urlparse(url).path
-        if not path or path == '/':  # Root path is usually HTML
-            return True
-
-        # Get the part after the last dot in the last segment of the path
-        last_segment = path.split('/')[-1]
-        if '.' in last_segment:
-            extension = last_segment.split('.')[-1].lower()
-            # List of common non-HTML extensions
-            non_html_extensions = {
-                'jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp',  # Images
-                'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'ppts', 'psd', 'rdf', 'm4v',  # Documents
-                'zip', 'rar', 'gz', 'tar', '7z',  # Archives
-                'css', 'js',  # Web resources (often linked, but not crawled for content)
-                'xml', 'json', 'csv', 'txt',  # Data formats
-                'mp3', 'mp4', 'avi', 'mov', 'wav',  # Media
-                'exe', 'dmg', 'iso' # Executables/Images
-            }
-            if extension in non_html_extensions:
-                return False
-        # No extension or unrecognized extension - assume it *might* be HTML
-        return True
+        # Only a known non-HTML extension on the last path segment rules it out;
+        # root paths, no extension or unrecognized extensions *might* be HTML
+        return not path.lower().endswith(_NON_HTML_SUFFIXES)
     except ValueError:
         return False # Malformed URL is unlikely to be HTML
 
+@functools.lru_cache(maxsize=_URL_CACHE_SIZE)
 def normalize_and_clean_url(href: str, base_url: str) -> Optional[str]:
     """
     Takes a potentially relative href and joins it with the base URL,
-    cleans it (removes fragment, optionally query/params), and validates the scheme.
+    cleans it (removes fragment, optionally query/params), validates the scheme
+    and canonicalizes it so equivalent URLs dedup to the same string
+    (lowercase host, no default port, no trailing index.html/index.php).
     Pure function.
 
     Args:
@@ -85,26 +98,41 @@ def normalize_and_clean_url(href: str, base_url: str) -> Optional[str]:
         # Create absolute URL (handles relative paths, // links etc.)
         absolute_url = parse.urljoin(base_url, href.strip())
 
-        # Parse the absolute URL
+        # Parse the absolute URL (urlparse already lowercases the scheme)
         url_parts = parse.urlparse(absolute_url)
+        scheme = url_parts.scheme
 
         # Basic validation: scheme and network location must exist
-        if not url_parts.scheme in ['http', 'https'] or not url_parts.netloc:
+        if not scheme in ['http', 'https'] or not url_parts.netloc:
             return None
 
+        # Canonicalize the host: lowercase (but not any user:password@ part),
+        # drop the scheme's default port
+        userinfo, at, hostport = url_parts.netloc.rpartition('@')
+        netloc = userinfo + at + hostport.lower()
+        if scheme == 'http' and netloc.endswith(':80'):
+            netloc = netloc[:-3]
+        elif scheme == 'https' and netloc.endswith(':443'):
+            netloc = netloc[:-4]
+
+        # Canonicalize the path: '/dir/index.html' is the same page as '/dir/'
+        path = url_parts.path or '/'
+        if path.endswith(('/index.html', '/index.php')):
+            path = path.rsplit('/', 1)[0] + '/'
+
         # Clean the URL: remove fragment, keep path, params, query
         # Modify here if you want to remove params or query: ['', '', ...]
         clean_url = parse.urlunparse((
-            url_parts.scheme,
-            url_parts.netloc,
-            url_parts.path,
+            scheme,
+            netloc,
+            path,
             '', # Remove params
             '', # Remove query
             '',  # Remove fragment
         ))
 
         # Optional: remove trailing slash for consistency, unless it's just the domain
-        if len(clean_url) > len(f"{url_parts.scheme}://{url_parts.netloc}") + 1 and clean_url.endswith('/'):
+        if len(clean_url) > len(f"{scheme}://{netloc}") + 1 and clean_url.endswith('/'):
              clean_url = clean_url.rstrip('/')
 
         return clean_url
@@ -137,103 +165,264 @@ def is_url_valid_for_host(url: str, required_host_substring: str) -> bool:
             is_likely_html_page(url))
 
 
-def extract_html_text(soup: BeautifulSoup) -> str:
+def extract_html_text(root: html.HtmlElement) -> str:
     """
-    Extracts all human-readable text content from a BeautifulSoup object.
-    Removes script/style tags and normalizes whitespace.
-    Effectively pure for its purpose (input soup -> output string).
+    Extracts all human-readable text content from a parsed lxml HTML tree.
+    Removes script/style tags (in place) and normalizes whitespace.
+    Effectively pure for its purpose (input tree -> output string).
 
     Args:
-        soup: A BeautifulSoup object representing the parsed HTML.
+        root: The root lxml element of the parsed HTML.
 
     Returns:
         A string containing the extracted text.
     """
-    # Remove script and style elements
-    for script_or_style in soup(["script", "style"]):
-        script_or_style.extract()
+    # Remove script and style elements, keeping any text that follows them
+    etree.strip_elements(root, "script", "style", with_tail=False)
 
-    # Get text and normalize whitespace
-    text = soup.get_text()
-    lines = (line.strip() for line in text.splitlines())
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  ")) # Split by double spaces too
-    text = '\n'.join(chunk for chunk in chunks if chunk)
-    return text
+    # One stripped text node per line, then collapse leftover runs of spaces
+    text = '\n'.join(chunk for chunk in (t.strip() for t in root.itertext()) if chunk)
+    return _WS_RE.sub(" ", text)
 
-def extract_valid_urls(soup: BeautifulSoup, base_url: str, required_host_substring: str) -> Set[str]:
+def extract_valid_urls(root: html.HtmlElement, base_url: str, required_host_substring: str) -> Set[str]:
     """
-    Finds all valid, absolute URLs within the desired host from a BeautifulSoup object.
+    Finds all valid, absolute URLs within the desired host from a parsed lxml HTML tree.
 
     Args:
-        soup: The BeautifulSoup object for the page.
+        root: The root lxml element of the page.
         base_url: The absolute URL of the page being parsed.
         required_host_substring: The substring the host of found URLs must contain.
 
     Returns:
         A set of valid, absolute URL strings.
     """
-    valid_urls: Set[str] = set()
-    for a_tag in soup.find_all('a', href=True):
-        href = a_tag['href']
-        if not href or href.startswith(('javascript:', 'mailto:', 'tel:', '#')):
-            continue
+    # iterlinks also yields src/action/etc. links; only follow anchors.
+    # Collecting into a set normalizes repeated hrefs (e.g. navigation) once.
+    hrefs = {
+        href for element, attribute, href, _ in root.iterlinks()
+        if attribute == 'href' and element.tag == 'a'
+        and href and not _SKIPPED_HREF_RE.match(href)
+    }
+    cleaned_urls = filter(None, (normalize_and_clean_url(href, base_url) for href in hrefs))
+    return {url for url in cleaned_urls if is_url_valid_for_host(url, required_host_substring)}
+
+def _detect_page_encoding(content: bytes) -> Optional[str]:
+    """
+    Picks an encoding for a page whose HTTP header gave no usable charset:
+    UTF-8 if the bytes decode as UTF-8, otherwise None to let lxml use the
+    page's <meta charset>. Without either, libxml2 falls back to Latin-1.
+    """
+    try:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return None
 
-        cleaned_url = normalize_and_clean_url(href, base_url)
+def parse_and_extract(content: bytes, base_url: str, required_host_substring: str,
+                      declared_encoding: Optional[str] = None) -> Tuple[str, Set[str]]:
+    """
+    Parses raw page bytes and extracts the page text and the valid URLs it links to.
+    A top-level function with picklable arguments and result, so it can run in
+    a worker process.
 
-        if cleaned_url and is_url_valid_for_host(cleaned_url, required_host_substring):
-            valid_urls.add(cleaned_url)
+    Args:
+        content: The raw HTML response body.
+        base_url: The absolute URL of the page.
+        required_host_substring: The substring the host of found URLs must contain.
+        declared_encoding: The charset from the response's Content-Type header, if any.
 
-    return valid_urls
+    Returns:
+        A (text, set of valid absolute URLs) tuple.
+    """
+    root = None
+    if declared_encoding:
+        try:
+            # Passed through as-is: libxml2 has its own charset names, which
+            # don't always match Python's codec names
+            root = html.document_fromstring(
+                content, parser=html.HTMLParser(encoding=declared_encoding)
+            )
+        except LookupError:
+            # libxml2 doesn't know the header's charset; decode with Python's
+            # codec if it does, otherwise detect the encoding below
+            try:
+                root = html.document_fromstring(content.decode(declared_encoding))
+            except (LookupError, UnicodeDecodeError, ValueError, etree.LxmlError):
+                pass
+        except etree.LxmlError as e:
+            # lxml errors carry an unpicklable error log; re-raise as a plain error
+            raise ValueError(f"Could not parse page: {e}") from None
+    if root is None:
+        encoding = _detect_page_encoding(content)
+        parser = html.HTMLParser(encoding=encoding) if encoding else None
+        try:
+            root = html.document_fromstring(content, parser=parser)
+        except etree.LxmlError as e:
+            raise ValueError(f"Could not parse page: {e}") from None
+    text = extract_html_text(root)
+    return text, extract_valid_urls(root, base_url, required_host_substring)
 
 
 # --- Functions with Side Effects (File I/O, State) ---
 
+# The index CSV is append-only, so it is read once and then mirrored in memory.
+# This turns every "already processed?" check into a set lookup instead of a
+# full parse of the file.
+_index_lock = threading.Lock()
+_indexed_urls: Set[str] = set()
+_max_index: int = 0
+_loaded_index_file: Optional[str] = None
+
+# Long-lived, buffered handle for appending to the index CSV. Rows are flushed
+# in batches of _INDEX_FLUSH_EVERY_ROWS and when the process exits.
+_INDEX_FLUSH_EVERY_ROWS = 64
+_index_fp: Optional[TextIO] = None
+_index_writer = None
+_index_pending_rows: int = 0
+
+def _canonicalize_stored_url(url: str) -> str:
+    """
+    Brings a URL saved by an older run (index CSV, legacy queue) into the
+    current normalize_and_clean_url form, so it still dedups against links
+    found on pages. URLs that no longer normalize are kept as they are.
+    """
+    return normalize_and_clean_url(url, url) or url
+
+def _load_index_once(filename: str = INDEX_FILE) -> None:
+    """
+    Loads the URLs and maximum index from the index CSV into memory.
+    Only reads the file on first use (or if a different file is requested).
+    """
+    global _max_index, _loaded_index_file
+    if _loaded_index_file == filename:
+        return
+    with _index_lock:
+        if _loaded_index_file == filename:
+            return # Loaded by another thread while waiting for the lock
+        urls: Set[str] = set()
+        max_index = 0
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8', newline='') as f:
+                    for row in csv.reader(f):
+                        # Rows are [index, file_path, url]; skip the header and malformed rows
+                        if len(row) < 3 or row[0] == 'index':
+                            continue
+                        urls.add(_canonicalize_stored_url(row[2]))
+                        try:
+                            max_index = max(max_index, int(row[0]))
+                        except ValueError:
+                            pass # Non-integer index, URL is still recorded
+            except Exception as e:
+                print(f"Error loading index from '{filename}': {e}")
+        _indexed_urls.clear()
+        _indexed_urls.update(urls)
+        _max_index = max_index
+        _loaded_index_file = filename
+
+def _get_index_writer(filename: str = INDEX_FILE):
+    """
+    Returns a csv.writer over an append handle to the index CSV, opening it
+    on first use. Writes the header row if the file is new. Callers must hold
+    _index_lock.
+    """
+    global _index_fp, _index_writer, _index_pending_rows
+    if _index_fp is None or _index_fp.name != filename:
+        if _index_fp is not None:
+            _index_fp.close()
+        _index_fp = open(filename, "a", encoding="utf-8", newline='', buffering=8192)
+        _index_writer = csv.writer(_index_fp)
+        _index_pending_rows = 0
+        if _index_fp.tell() == 0:
+            _index_writer.writerow(['index', 'file_path', 'url'])
+    return _index_writer
+
+def flush_index_file() -> None:
+    """Flushes buffered index CSV rows to the file, if the handle is open."""
+    global _index_pending_rows
+    with _index_lock:
+        if _index_fp is not None:
+            _index_fp.flush()
+            _index_pending_rows = 0
+
+def close_index_file() -> None:
+    """
+    Flushes and closes the index CSV handle, if open. Also runs at exit so
+    buffered rows are not lost; a later write reopens the file.
+    """
+    global _index_fp, _index_writer
+    with _index_lock:
+        if _index_fp is not None:
+            _index_fp.close()
+            _index_fp = None
+            _index_writer = None
+
+atexit.register(close_index_file)
+
 def get_max_index(filename: str = INDEX_FILE) -> int:
     """
     Gets the maximum index value from the 'index' column of the index CSV.
+    The file is only read once; later writes keep the value up to date.
 
     Returns:
         The maximum index found, or 0 if the file doesn't exist, is empty,
         or has no valid integer indices.
     """
-    if not os.path.exists(filename):
-        return 0
-    try:
-        df = pd.read_csv(filename)
-        if df.empty or 'index' not in df.columns:
-            return 0
-        # Attempt conversion to numeric, coercing errors to NaN, then drop NaNs and find max
-        numeric_indices = pd.to_numeric(df['index'], errors='coerce').dropna()
-        if numeric_indices.empty:
-            return 0
-        return int(numeric_indices.max()) # Convert float max back to int
-    except pd.errors.EmptyDataError:
-        return 0 # File exists but is empty
-    except Exception as e:
-        print(f"Error reading max index from '{filename}': {e}")
-        return 0 # Return safe default on unexpected errors
+    _load_index_once(filename)
+    return _max_index
 
 def url_exists_in_index(url: str, filename: str = INDEX_FILE) -> bool:
     """Checks if a URL already exists in the 'url' column of the index CSV."""
-    if not os.path.exists(filename):
-        return False
-    try:
-        df = pd.read_csv(filename)
-        if df.empty or 'url' not in df.columns:
-            return False
-        return url in df['url'].values
-    except pd.errors.EmptyDataError:
-        return False # File exists but is empty
-    except Exception as e:
-        print(f"Error checking URL existence in '{filename}': {e}")
-        return False # Be cautious on error, assume it doesn't exist to allow potential processing
+    _load_index_once(filename)
+    return url in _indexed_urls
+
+# Content directory that has been created, and an fd for it when the platform
+# supports dir_fd (None otherwise, e.g. on Windows)
+_content_dir_lock = threading.Lock()
+_content_dir: Optional[str] = None
+_content_dir_fd: Optional[int] = None
+
+def _get_content_dir_fd(content_dir: str = FILES_DIR) -> Optional[int]:
+    """
+    Creates the content directory on first use and returns an open fd for it,
+    so content files can be created relative to it without re-resolving the
+    path. Returns None if os.open doesn't support dir_fd on this platform.
+    """
+    global _content_dir, _content_dir_fd
+    if _content_dir == content_dir:
+        return _content_dir_fd
+    with _content_dir_lock:
+        if _content_dir != content_dir:
+            os.makedirs(content_dir, exist_ok=True)
+            if _content_dir_fd is not None:
+                os.close(_content_dir_fd)
+            _content_dir_fd = (os.open(content_dir, os.O_RDONLY)
+                               if os.open in os.supports_dir_fd else None)
+            _content_dir = content_dir
+        return _content_dir_fd
+
+def close_content_dir() -> None:
+    """
+    Closes the content directory fd, if open. Also runs at exit; a later
+    write reopens it.
+    """
+    global _content_dir, _content_dir_fd
+    with _content_dir_lock:
+        if _content_dir_fd is not None:
+            os.close(_content_dir_fd)
+        _content_dir = None
+        _content_dir_fd = None
+
+atexit.register(close_content_dir)
 
 def write_content_file(content: str, index: int, url: str,
                        index_filename: str = INDEX_FILE,
                        content_dir: str = FILES_DIR) -> bool:
     """
     Writes content to a text file named '{index}.txt' inside 'content_dir'
-    and adds an entry to the index CSV *only if* the URL is not already in the index.
+    and adds an entry to the index CSV. Does not check whether the URL is
+    already indexed; callers are responsible for checking url_exists_in_index
+    (and not processing the same URL twice) beforehand.
 
     Args:
         content: The text content to write.
@@ -243,29 +432,43 @@ def write_content_file(content: str, index: int, url: str,
         content_dir: Directory to save the content files.
 
     Returns:
-        True if the file was newly written and index updated, False if the URL
-        already existed in the index or an error occurred.
+        True if the file was written and index updated, False if an error occurred.
     """
-    # Check if URL already processed before doing any writing
-    if url_exists_in_index(url, index_filename):
-        # print(f"Debug: URL {url} already in index, skipping write.") # Optional debug
-        return False
+    global _max_index, _index_pending_rows
+
+    # Make sure the in-memory index is loaded before it is updated below
+    _load_index_once(index_filename)
 
     try:
-        # Ensure content directory exists
-        os.makedirs(content_dir, exist_ok=True)
+        # Content directory is created once; writes go relative to its fd where supported
+        dir_fd = _get_content_dir_fd(content_dir)
 
-        # Create the full path for the content file
-        file_path = os.path.join(content_dir, f"{index}.txt")
+        # Full path of the content file, as recorded in the index
+        file_name = f"{index}.txt"
+        file_path = os.path.join(content_dir, file_name)
 
         # Write the content to the file
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(content)
-
-        # Append the new entry to the index CSV
-        with open(index_filename, "a", encoding="utf-8", newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([index, file_path, url])
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if dir_fd is not None:
+            fd = os.open(file_name, flags, 0o644, dir_fd=dir_fd)
+        else:
+            fd = os.open(file_path, flags, 0o644)
+        try:
+            data = memoryview(content.encode("utf-8"))
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+        # Append the new entry to the index CSV and mirror it in memory
+        with _index_lock:
+            _get_index_writer(index_filename).writerow([index, file_path, url])
+            _index_pending_rows += 1
+            if _index_pending_rows >= _INDEX_FLUSH_EVERY_ROWS:
+                _index_fp.flush()
+                _index_pending_rows = 0
+            _indexed_urls.add(url)
+            _max_index = max(_max_index, index)
 
         return True # Success
 
@@ -277,27 +480,163 @@ def write_content_file(content: str, index: int, url: str,
         print(f"Unexpected error writing file/index for URL '{url}': {e}")
         return False
 
-def load_queue_from_file(filename: str = QUEUE_FILE) -> Deque[str]:
-    """Loads the crawl queue from a text file (one URL per line)."""
-    if not os.path.exists(filename):
-        return deque()
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            urls = [line.strip() for line in f if line.strip()]
-            return deque(urls)
-    except Exception as e:
-        print(f"Error loading queue file '{filename}': {e}. Starting fresh.")
-        return deque()
+class MmapUrlQueue:
+    """
+    FIFO queue of URLs persisted in a memory-mapped file, so enqueueing and
+    dequeueing are O(1) writes into the mapping and resuming a crawl only maps
+    the file instead of reading it line by line.
+
+    Layout: a 16-byte header holding the committed read offset and the write
+    offset, followed by records of [u16 length][UTF-8 URL bytes].
+
+    take() hands out URLs without touching the header. The committed offset
+    only moves past a URL once it has been marked with task_done() and
+    commit() is called, so URLs that were taken but not finished (or whose
+    results were not yet flushed by the caller) are replayed after a crash.
+    Consumed space before the committed offset is reclaimed when the queue
+    empties, or when the file is full and the live records fit in it.
+    """
+    _HEADER = struct.Struct('<QQ')
+    _LENGTH = struct.Struct('<H')
+    _INITIAL_SIZE = 1 << 20
 
-def save_queue_to_file(queue: Deque[str], filename: str = QUEUE_FILE):
-    """Saves the crawl queue to a text file (one URL per line)."""
-    # Ensure parent directory exists if filename includes path separators
-    try:
+    def __init__(self, filename: str = QUEUE_FILE):
         os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
-        with open(filename, 'w', encoding='utf-8') as f:
-            for url in queue:
-                f.write(url + '\n')
-    except OSError as e:
-        print(f"Error saving queue to '{filename}': {e}")
-    except Exception as e:
-        print(f"Unexpected error saving queue to '{filename}': {e}")
\ No newline at end of file
+        self.filename = filename
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < self._INITIAL_SIZE:
+            os.ftruncate(self._fd, self._INITIAL_SIZE)
+        self._mm = mmap.mmap(self._fd, 0)
+
+        start = self._HEADER.size
+        self._committed, self._write = self._HEADER.unpack_from(self._mm, 0)
+        if not start <= self._committed <= self._write <= len(self._mm):
+            if size:
+                print(f"Queue file '{filename}' has an invalid header. Starting fresh.")
+            self._committed = self._write = start
+            self._store_header()
+        # Next record to hand out; resumes from the last committed position
+        self._read = self._committed
+        # Taken but not yet done URLs: token -> record offset, in take() order
+        self._in_flight: Dict[int, int] = {}
+        self._next_token = 0
+
+    def _store_header(self) -> None:
+        """Writes the committed/write offsets to the header (after the records they cover)."""
+        self._HEADER.pack_into(self._mm, 0, self._committed, self._write)
+
+    def _make_room(self, needed: int) -> None:
+        """Ensures `needed` bytes fit after the write offset, reclaiming or growing the file."""
+        if self._write + needed <= len(self._mm):
+            return
+        start = self._HEADER.size
+        live = self._write - self._committed
+        # Only move the live records if they don't overlap their old location, so
+        # a crash before the header update leaves the old records intact
+        if self._committed - start >= live and start + live + needed <= len(self._mm):
+            self._mm[start:start + live] = self._mm[self._committed:self._write]
+            shift = self._committed - start
+            self._committed -= shift
+            self._read -= shift
+            self._write -= shift
+            for token in self._in_flight:
+                self._in_flight[token] -= shift
+            self._store_header()
+            return
+        new_size = max(len(self._mm) * 2, self._write + needed)
+        self._mm.close()
+        os.ftruncate(self._fd, new_size)
+        self._mm = mmap.mmap(self._fd, 0)
+
+    def _record_at(self, offset: int) -> Tuple[str, int]:
+        """Returns the URL stored at `offset` and the offset of the next record."""
+        (length,) = self._LENGTH.unpack_from(self._mm, offset)
+        start = offset + self._LENGTH.size
+        return self._mm[start:start + length].decode('utf-8'), start + length
+
+    def append(self, url: str) -> None:
+        """Adds a URL to the end of the queue. URLs over 64 KB are skipped."""
+        data = url.encode('utf-8')
+        if len(data) > 0xFFFF:
+            print(f"Skipping URL too long to queue: {url[:100]}...")
+            return
+        record_size = self._LENGTH.size + len(data)
+        self._make_room(record_size)
+        self._LENGTH.pack_into(self._mm, self._write, len(data))
+        self._mm[self._write + self._LENGTH.size:self._write + record_size] = data
+        self._write += record_size
+        self._store_header()
+
+    def extend(self, urls: Iterable[str]) -> None:
+        """Adds several URLs to the end of the queue, in order."""
+        for url in urls:
+            self.append(url)
+
+    def take(self) -> Tuple[int, str]:
+        """
+        Hands out the next URL as a (token, url) pair. The URL stays in the
+        file until task_done(token) and a later commit(). Raises IndexError if
+        there is nothing left to take.
+        """
+        if self._read >= self._write:
+            raise IndexError("take from an empty queue")
+        token = self._next_token
+        self._next_token += 1
+        self._in_flight[token] = self._read
+        url, self._read = self._record_at(self._read)
+        return token, url
+
+    def task_done(self, token: int) -> None:
+        """Marks a URL handed out by take() as finished."""
+        del self._in_flight[token]
+
+    def commit(self) -> None:
+        """
+        Advances the committed offset up to the oldest unfinished URL. Callers
+        must have persisted the results of every finished URL first.
+        """
+        # Dicts keep insertion order, so the first in-flight record is the oldest
+        self._committed = next(iter(self._in_flight.values()), self._read)
+        if self._committed == self._write:
+            # Empty again: rewind so the file doesn't keep growing
+            self._committed = self._read = self._write = self._HEADER.size
+        self._store_header()
+
+    def __bool__(self) -> bool:
+        """True if there are URLs left to take."""
+        return self._read < self._write
+
+    def __iter__(self):
+        """Iterates over the URLs left to take, front to back, without removing them."""
+        offset = self._read
+        while offset < self._write:
+            url, offset = self._record_at(offset)
+            yield url
+
+    def close(self) -> None:
+        """Flushes the mapping to disk and closes the file. Does not commit."""
+        self._mm.flush()
+        self._mm.close()
+        os.close(self._fd)
+
+def load_queue_from_file(filename: str = QUEUE_FILE,
+                         legacy_filename: str = LEGACY_QUEUE_FILE) -> MmapUrlQueue:
+    """
+    Opens the persistent crawl queue. If it is empty and a queue saved in the
+    old text format (one URL per line) exists, its URLs are imported once and
+    the text file is removed.
+    """
+    queue = MmapUrlQueue(filename)
+    if not queue and os.path.exists(legacy_filename):
+        try:
+            with open(legacy_filename, 'r', encoding='utf-8') as f:
+                urls = [_canonicalize_stored_url(line.strip()) for line in f if line.strip()]
+            # dict.fromkeys keeps the first occurrence of each URL, in order
+            unique_urls = list(dict.fromkeys(urls))
+            queue.extend(unique_urls)
+            os.remove(legacy_filename)
+            print(f"Imported {len(unique_urls)} URLs from legacy queue file '{legacy_filename}'.")
+        except Exception as e:
+            print(f"Error importing legacy queue file '{legacy_filename}': {e}")
+    return queue